@@ -23,24 +23,32 @@
 
 import argparse
 import base64
-import bz2
+import io
 import logging
 import json
 import os
-import random
 import shutil
 import stat
-import string
 import sys
 import tarfile
+import threading
 import time
 
+from contextlib import closing
+
 try:
+    from httplib import HTTPException
     from urlparse import urlparse
-    from urllib import urlretrieve
+    from urllib2 import urlopen, Request
 except ImportError:  # Py3
+    from http.client import HTTPException
     from urllib.parse import urlparse
-    from urllib.request import urlretrieve
+    from urllib.request import urlopen, Request
+
+try:
+    from os import replace
+except ImportError:  # Py2
+    from os import rename as replace
 
 # Required as the Python code is usually concatenated into a single file and
 # embedded in the Cypress C++ library.
@@ -87,27 +95,44 @@ args = parser.parse_args()
 
 
 def tmpdirname(N):
-    return ''.join(random.choice(string.ascii_uppercase +
-                                 string.ascii_lowercase + string.digits) for _ in range(N))
-
+    # Each base32 character encodes five random bits
+    name = base64.b32encode(os.urandom((N * 5 + 7) // 8))
+    if not isinstance(name, str):
+        name = name.decode('ascii')  # Py3
+    return name[:N].lower()
+
+
+def bundle(files):
+    # Pack all files into a single compressed tar archive, this allows the
+    # compressor to exploit redundancy between the files. The archive members
+    # retain the file modes. Symlinks are dereferenced, they would dangle on
+    # the NMPI machine. Use bz2 rather than xz, the Python version on the NMPI
+    # machine may lack the lzma module.
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:bz2", dereference=True,
+                      compresslevel=9) as tar:
+        for filename, tar_filename in files:
+            # Build the archive member with a single stat call and only open
+            # regular files, opening a FIFO or a device may block
+            try:
+                info = tar.gettarinfo(filename, arcname=tar_filename)
+            except (IOError, OSError):
+                continue
+            if info.isreg():
+                with open(filename, 'rb') as fd:
+                    tar.addfile(info, fd)
 
-def file_script(filename, tar_filename, execute):
-    if not os.path.isfile(filename):
-        return ""
-    with open(filename, 'r') as fd:
-        compressed = base64.b64encode(bz2.compress(fd.read()))
-    return ("extract('" + tar_filename
-            + "', 0o" + oct(os.stat(filename)[stat.ST_MODE])
-            + ", '" + compressed + "')\n")
+    # Return the native string type in both Python 2 and 3
+    data = base64.b64encode(buf.getvalue())
+    return data if isinstance(data, str) else data.decode('ascii')
 
 tmpdir = "cypress_" + tmpdirname(8)
-script = """
+script_header = """
 
 # Automatically generated by Cypress
 
 import base64
-import bz2
-import errno
+import io
 import os
 import shutil
 import subprocess
@@ -115,54 +140,30 @@ import sys
 import tarfile
 
 # Remember which files were extracted -- we'll cleanup our traces after running
-dir = os.path.realpath(os.path.join(os.getcwd(), '""" + tmpdir + """'))
+dir = os.path.realpath(os.path.join(os.getcwd(), '%(tmpdir)s'))
 files = []
 
-# http://stackoverflow.com/questions/600268/mkdir-p-functionality-in-python
-def mkdir_p(path):
-    try:
-        if (path != ""):
-            os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-
 def setup():
-    # List files in the current directory and link them into the target
-    # directory
-    for filename in os.listdir("."):
-        source = os.path.realpath(os.path.join(".", filename))
-        target = os.path.join(dir, filename)
-        if target == dir or os.path.exists(target):
-            continue
-        os.symlink(source, target)
+    # Make the current directory available to the executable via a single
+    # "host" symlink in the target directory instead of linking each file
+    target = os.path.join(dir, "host")
+    if not os.path.lexists(target):
+        os.symlink(os.getcwd(), target)
 
         # Important! Unlink file before recursively deleting subdirectory
         files.append(target)
 
-def extract(filename, mode, data):
-    filename = os.path.join(dir, filename)
-    files.append(filename)
-    mkdir_p(os.path.dirname(filename))
-    with open(filename, 'w') as fd:
-        fd.write(bz2.decompress(base64.b64decode(data)))
-    os.chmod(filename, mode)
+def extract(data):
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(data)),
+                      mode="r:bz2") as tar:
+        files.extend(os.path.join(dir, name) for name in tar.getnames())
+        tar.extractall(dir)
 
 def run(filename, args):
-    old_cwd = os.getcwd()
-    res = 1
-    try:
-        os.chdir(dir)
-        with open(os.path.join(dir, '"""  + tmpdir + """.stdout'), 'wb') as out, open(os.path.join(dir, '"""  + tmpdir + """.stderr'), 'wb') as err:
-            p = subprocess.Popen([os.path.join(dir, filename)] + args,
-                stdout = out, stderr = err)
-            p.communicate()
-            res = p.returncode
-    finally:
-        os.chdir(old_cwd)
-    return res
+    with open(os.path.join(dir, '%(tmpdir)s.stdout'), 'wb') as out, open(os.path.join(dir, '%(tmpdir)s.stderr'), 'wb') as err:
+        p = subprocess.Popen([os.path.join(dir, filename)] + args,
+            cwd = dir, stdout = out, stderr = err)
+        return p.wait()
 
 def cleanup():
     pass
@@ -173,38 +174,57 @@ def cleanup():
     #    except:
     #        pass
 
-    # Create a tar.bz2 of the target folder containing all the output
+    # Create a tar.bz2 of the target folder containing all the output. Write it
+    # as a stream, the compressed data is written to disk while the files are
+    # added.
     tarname = os.path.basename(dir)
     archive = tarname + ".tar.bz2"
-    with tarfile.open(archive, "w:bz2") as tar:
+    with tarfile.open(archive, "w|bz2", bufsize=128 * 1024) as tar:
         tar.add(dir, arcname=tarname)
 
     # Remove the target directory
     shutil.rmtree(dir)
-"""
+""" % {"tmpdir": tmpdir}
+
+# Normalise the base directory once instead of in each relpath call
+base = os.path.abspath(args.base)
 
 files = args.files + [args.executable]
+bundle_files = []
 for filename in files:
-    tar_filename = os.path.relpath(filename, args.base)
+    tar_filename = os.path.relpath(filename, base)
     if (tar_filename.startswith("..")):
         raise Exception(
             "Base directory must be a parent directory of all specified files!")
-    script = script + file_script(filename,
-                                  tar_filename,
-                                  filename == args.executable)
+    bundle_files.append((filename, tar_filename))
+
+# Compress the files in a background thread while the NMPI client
+# configuration is read and the user is prompted for missing values and the
+# password. The bz2 compressor releases the GIL while compressing.
+bundle_result = {}
+
+
+def bundle_thread_main():
+    try:
+        bundle_result["data"] = bundle(bundle_files)
+    except Exception as e:
+        bundle_result["error"] = e
 
+bundle_thread = threading.Thread(target=bundle_thread_main)
+bundle_thread.daemon = True
+bundle_thread.start()
+
+# Arguments referring to files are translated to paths relative to the base
+# directory, use a single stat call to find out whether this is the case
 arguments = []
 for arg in args.args:
-    if os.path.exists(arg) and os.path.isfile(arg):
-        arguments.append(os.path.relpath(arg, args.base))
-    else:
-        arguments.append(arg)
-
-script = script + "setup()\n"
-script = script + ("res = run('" + os.path.relpath(filename, args.base)
-                   + "', " + str(arguments) + ")\n")
-script = script + "cleanup()\n"
-script = script + "sys.exit(res)\n"
+    try:
+        if stat.S_ISREG(os.stat(arg).st_mode):
+            arguments.append(os.path.relpath(arg, base))
+            continue
+    except OSError:
+        pass
+    arguments.append(arg)
 
 #
 # Read the NMPI client configuration
@@ -231,7 +251,32 @@ if not "collab_id" in config:
 if not "username" in config:
     config["username"] = raw_input("Username: ")
 
+
+def build_script(data):
+    # Collect the script parts in a list and join them once, the embedded
+    # archive may be large
+    script = ''.join([
+        script_header,
+        "extract('", data, "')\n",
+        "setup()\n",
+        "res = run('" + os.path.relpath(args.executable, base)
+        + "', " + str(arguments) + ")\n",
+        "cleanup()\n",
+        "sys.exit(res)\n"])
+
+    # Make sure the script is pure ASCII, this allows the JSON encoder used by
+    # the NMPI client to take its fast path. Non-ASCII characters can only
+    # occur in the file names and arguments inside string literals, where the
+    # escaped form has the same meaning. On Python 2 the script is a native
+    # byte string, as tmpdirname() and bundle() return native strings, and is
+    # passed verbatim.
+    if not isinstance(script, bytes):
+        script = script.encode('ascii', 'backslashreplace').decode('ascii')
+    return script
+
+
 # Create the client instance
+script = None
 token = config["token"] if "token" in config else None
 while True:
     if token is None:
@@ -241,8 +286,6 @@ while True:
     sys.stdout.flush()
     sys.stderr.flush()
 
-    time.sleep(0.1)
-
     # Submit the job, if this fails, explicitly query the password
     try:
         client = Client(username=config["username"], token=token)
@@ -255,6 +298,14 @@ while True:
         if(args.wafer != 0):
             hw_config = {"WAFER_MODULE" : args.wafer}
 
+        # The files were compressed while Client() prompted for the password,
+        # wait for the result and assemble the script
+        if script is None:
+            bundle_thread.join()
+            if "error" in bundle_result:
+                break
+            script = build_script(bundle_result["data"])
+
         job_id = client.submit_job(
             source=script,
             platform=args.platform,
@@ -275,16 +326,93 @@ while True:
             raise
     break
 
-# Wait until the job has switched to either the "error" or the "finished" state
+# Compressing the files failed
+if "error" in bundle_result:
+    raise bundle_result["error"]
+
+# Wait until the job has switched to either the "error" or the "finished" state.
+# Increase the polling interval while the status does not change to reduce the
+# number of requests issued for long running jobs.
 status = ""
+delay = 1.0
 while True:
     new_status = client.job_status(job_id)
     if new_status != status:
         logger.info("Job status: " + new_status)
         status = new_status
+        delay = 1.0
     if status == "error" or status == "finished":
         break
-    time.sleep(1)
+    time.sleep(delay)
+    delay = min(delay * 1.5, 30.0)
+
+
+class ResumableDownload(object):
+    # File-like object reading the resource at the given URL. If the connection
+    # breaks, the download is resumed at the current position using an HTTP
+    # Range request instead of transferring the data again.
+
+    def __init__(self, url, retries=5):
+        self.url = url
+        self.retries = retries
+        self.offset = 0
+        self.response = urlopen(url)
+        self.length = self._content_length()
+
+    def _content_length(self):
+        length = self.response.info().get("Content-Length")
+        return None if length is None else int(length)
+
+    def _resume(self):
+        self.response.close()
+        self.response = urlopen(Request(
+            self.url, headers={"Range": "bytes=%d-" % self.offset}))
+        self.length = self._content_length()
+
+        if self.response.getcode() == 206:
+            if self.length is not None:
+                self.length = self.length + self.offset
+        else:
+            # The server ignored the Range header and sends the entire
+            # resource, skip the part which has already been read
+            skip = self.offset
+            while skip > 0:
+                data = self.response.read(min(skip, 1024 * 1024))
+                if not data:
+                    raise IOError("Resource shrunk while resuming download")
+                skip -= len(data)
+
+    def read(self, size=-1):
+        # Reconnect inside the retried block, so a failing reconnect consumes
+        # a retry as well instead of aborting the download
+        resume = False
+        while True:
+            try:
+                if resume:
+                    self._resume()
+                    resume = False
+                data = self.response.read(size)
+
+                # The connection was closed before the advertised amount of
+                # data was transferred
+                if (not data and size != 0 and self.length is not None
+                        and self.offset < self.length):
+                    raise IOError("Connection closed prematurely")
+                break
+            except (IOError, HTTPException) as e:
+                if self.retries == 0:
+                    raise
+                self.retries = self.retries - 1
+                logger.warning("Connection lost (" + str(e) + "), resuming "
+                               + "download at byte " + str(self.offset))
+                time.sleep(1)
+                resume = True
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.response.close()
+
 
 # Download the result archive
 job = client.get_job(job_id)
@@ -294,44 +422,72 @@ for dataitem in datalist:
     (scheme, netloc, path, params, query, fragment) = urlparse(url)
     archive = tmpdir + ".tar.bz2"
     if archive in path:
-        # Download the archive containing the result data
-        logger.info("Downloading result...")
-        urlretrieve(url, archive)
-
-        # Extract the output to the temporary directory
-        logger.info("Extracting data...")
-        with tarfile.open(archive, "r:*") as tar:
-            members = [member for member in tar.getmembers(
-            ) if member.name.startswith(tmpdir)]
-            tar.extractall(members=members)
-        os.unlink(archive)
+        # Download the archive containing the result data and extract the
+        # output to the temporary directory. The archive is read as a stream
+        # directly from the (resumable) download and is never written to disk;
+        # members are extracted while reading the headers. Remember the regular
+        # files located directly in the temporary directory, the member
+        # information makes listing and stat-ing the directory afterwards
+        # unnecessary.
+        logger.info("Downloading and extracting result...")
+        result_files = []
+        prefix = tmpdir + "/"
+        prefix_len = len(prefix)
+        with closing(ResumableDownload(url)) as response:
+            with tarfile.open(fileobj=response, mode="r|*",
+                              bufsize=1024 * 1024) as tar:
+                for member in tar:
+                    name = member.name
+                    if name[:prefix_len] == prefix:
+                        tar.extract(member)
+                        name = name[prefix_len:]
+                        if member.isreg() and not "/" in name:
+                            result_files.append(name)
 
         # Move the content from the temporary directory to the top-level
-        # directory, remove the temporary directory
-        for filename in os.listdir(tmpdir):
+        # directory, remove the temporary directory. The temporary directory
+        # resides in the current directory, so renaming the files is
+        # sufficient. Existing files are overwritten by copying, renaming
+        # would replace local symlinks or a running executable instead of
+        # writing to them; copy as well if renaming fails. Directories and
+        # symlinks (which point at files on the NMPI machine) are not part of
+        # result_files.
+        for filename in result_files:
             src = os.path.join(tmpdir, filename)
             dest = os.path.join(os.getcwd(), filename)
             try:
-                if not os.path.isdir(src):
+                if os.path.lexists(dest):
                     shutil.copy(src, dest)
-            except: 
+                else:
+                    try:
+                        replace(src, dest)
+                    except OSError:
+                        shutil.copy(src, dest)
+            except:
                 pass
         shutil.rmtree(tmpdir)
 
         logger.info("Done!")
         break
 
+
+def write_file(filename, stream):
+    # Write the content of the file with a single call to the underlying binary
+    # stream (Python 3) instead of line by line
+    with open(filename, 'rb') as f:
+        data = f.read()
+    stream.flush()
+    getattr(stream, 'buffer', stream).write(data)
+    stream.flush()
+
+
 # Output both stdout and stderr
 if os.path.isfile(tmpdir + ".stderr") and os.stat(tmpdir + ".stderr").st_size > 0:
     logger.info("Response stderr (" + tmpdir + ".stderr)")
-    with open(tmpdir + ".stderr") as f:
-        for s in f:
-            sys.stderr.write(s)
+    write_file(tmpdir + ".stderr", sys.stderr)
 if os.path.isfile(tmpdir + ".stdout") and os.stat(tmpdir + ".stdout").st_size > 0:
     logger.info("Response stdout (" + tmpdir + ".stdout)")
-    with open(tmpdir + ".stdout") as f:
-        for s in f:
-            sys.stdout.write(s)
+    write_file(tmpdir + ".stdout", sys.stdout)
 
 # Exit with the correct status
 sys.exit(0 if status == "finished" else 1)